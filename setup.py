@@ -10,8 +10,8 @@ import re
 
 VERSIONFILE = "slurm_job_tunnel/_version.py"
 verstrline = open(VERSIONFILE, "rt").read()
-VSRE = r"^__version__ = ['\"]([^'\"]*)['\"]"
-mo = re.search(VSRE, verstrline, re.M)
+VSRE = re.compile(r"^__version__ = ['\"]([^'\"]*)['\"]", re.M)
+mo = VSRE.search(verstrline)
 if mo:
     verstr = mo.group(1)
 else:
@@ -24,7 +24,6 @@ setup(
     packages=find_packages(),
     install_requires=[
         "slurm-job-util @ git+https://github.com/wvdtoorn/slurm-job-util.git",
-        "pexpect",
     ],
     entry_points={
         "console_scripts": [
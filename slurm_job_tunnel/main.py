@@ -9,22 +9,72 @@ import argparse
 import os
 import json
 from dataclasses import fields
+from functools import lru_cache
 
 from .tunnel_config import TunnelConfig
-from .run_tunnel import run_tunnel
 
 CONFIG_DIR = os.path.join(os.path.expanduser("~"), ".slurm-job-tunnel")
 CONFIG_FILE = os.path.join(CONFIG_DIR, "config.json")
 
 
+def _resolve_type(field_type):
+    try:  # If field_type is a Optional union, get the first type
+        field_args = field_type.__args__  # type: ignore
+        if len(field_args) == 2 and field_args[1] is type(None):
+            field_type = field_args[0]
+        elif len(field_args) == 1:
+            field_type = field_args[0]
+        else:
+            raise ValueError(f"Invalid field type: {field_type}")
+    except AttributeError:
+        pass
+    return field_type
+
+
+def _positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
+
+
+# argument types of fields that need stricter validation than their annotation
+FIELD_TYPES = {
+    "max_poll_interval": _positive_int,
+}
+
+# (name, type, help) of the config fields exposed as command line options
+FIELD_SPECS = [
+    (
+        field.name,
+        FIELD_TYPES.get(field.name, _resolve_type(field.type)),
+        TunnelConfig.help(field.name),
+    )
+    for field in fields(TunnelConfig)
+    if not field.name.startswith("_")
+]
+
+
+@lru_cache(maxsize=1)
+def _read_config_file(mtime: float) -> dict:
+    # keyed on the modification time, so edits to the file are picked up
+    with open(CONFIG_FILE, "r") as f:
+        return json.load(f)
+
+
 def load_config() -> TunnelConfig:
     if os.path.exists(CONFIG_FILE):
-        with open(CONFIG_FILE, "r") as f:
-            return TunnelConfig(**json.load(f))
+        return TunnelConfig(**_read_config_file(os.path.getmtime(CONFIG_FILE)))
     return TunnelConfig()
 
 
-def parse_args() -> tuple[str, TunnelConfig]:
+def parse_args() -> tuple[str, TunnelConfig, TunnelConfig]:
+    """
+    Parse the command line arguments.
+
+    Returns the mode, the config to run with (file config overridden by the
+    arguments), and the config as loaded from the config file.
+    """
     config = load_config()
     DEFAULT_CONFIG = TunnelConfig()
 
@@ -58,39 +108,26 @@ def parse_args() -> tuple[str, TunnelConfig]:
         help="Show the configuration.",
     )
 
-    for field in fields(TunnelConfig):
-        if not field.name.startswith("_"):
-            field_type = field.type
-
-            try:  # If field_type is a Optional union, get the first type
-                field_args = field_type.__args__  # type: ignore
-                if len(field_args) == 2 and field_args[1] is type(None):
-                    field_type = field_args[0]
-                elif len(field_args) == 1:
-                    field_type = field_args[0]
-                else:
-                    raise ValueError(f"Invalid field type: {field_type}")
-            except AttributeError:
-                pass
-
-            help_text = TunnelConfig.help(field.name)
-            for subparser in [init_parser, run_parser]:
-                subparser.add_argument(
-                    f"--{field.name}",
-                    type=field_type,
-                    default=get_from_config(field.name),
-                    help=help_text + f" (default: {get_from_config(field.name)})",
-                )
+    for name, field_type, help_text in FIELD_SPECS:
+        for subparser in [init_parser, run_parser]:
+            subparser.add_argument(
+                f"--{name}",
+                type=field_type,
+                default=get_from_config(name),
+                help=help_text + f" (default: {get_from_config(name)})",
+            )
 
     args = parser.parse_args()
-    return args.mode, TunnelConfig(
-        **{k: v for k, v in args.__dict__.items() if k != "mode"}
+    return (
+        args.mode,
+        TunnelConfig(**{k: v for k, v in args.__dict__.items() if k != "mode"}),
+        config,
     )
 
 
 def main():
 
-    mode, tunnel_config = parse_args()
+    mode, tunnel_config, loaded_config = parse_args()
     if mode == "reset":
         if os.path.exists(CONFIG_FILE):
             os.remove(CONFIG_FILE)
@@ -115,9 +152,12 @@ def main():
         print(f"Default job tunnel configuration saved to {CONFIG_FILE}")
 
     elif mode == "show":
-        print(load_config())
+        print(loaded_config)
 
     elif mode == "run":
+        # imported lazily: slurm_job_util is only needed here
+        from .run_tunnel import run_tunnel
+
         run_tunnel(tunnel_config)
 
     else:
@@ -6,43 +6,69 @@ Copyright (c) 2024 by Wiep K. van der Toorn
 """
 
 import os
+import re
+import select
+import shlex
 import signal
 import subprocess
 import time
 import logging
 from datetime import datetime
-from typing import List, Tuple, TYPE_CHECKING
-from dataclasses import dataclass
+from pathlib import PurePosixPath
+from typing import IO, Dict, List, Tuple, TYPE_CHECKING
+from dataclasses import dataclass, field
 import sys
-import tkinter as tk
-from tkinter import messagebox
 import socket
+import tempfile
 import threading
-import pexpect
 
-from slurm_job_util.slurm_job import SBatchCommand, SlurmJob
+from slurm_job_util.slurm_job import SBatchCommand
 from slurm_job_util.ssh_config import SSHConfig, SSHConfigEntry
-from slurm_job_util.utils import execute_on_host
 
 if TYPE_CHECKING:
     from .tunnel_config import TunnelConfig
 
+logger = logging.getLogger(__name__)
+
 SBATCH_SCRIPT = os.path.join(
     os.path.dirname(os.path.dirname(__file__)), "tunnel.sbatch"
 )
+SSH_CONFIG_PATH = os.path.join(os.path.expanduser("~"), ".ssh", "config")
 
+SBATCH_JOB_ID_RE = re.compile(r"Submitted batch job (\d+)")
+PORT_RE = re.compile(r"PORT=(\d+)")
+NODE_RE = re.compile(r"NODE=(\S+)")
+TERMINATION_TIME_RE = re.compile(r"This tunnel will close at: (.+)")
+END_TIME_RE = re.compile(r"^END_TIME=(\d+)")
+STARTED_RE = re.compile(r"^STARTED=1$")
 
-def show_time_limit_warning():
+
+def _popup_root():
     """
-    Show a blocking popup with the time limit warning.
+    Create a hidden, topmost Tk root to parent a popup. tkinter is imported
+    here, so it is only loaded once a popup is shown. Tk interpreters are bound
+    to the thread that created them, so each popup thread needs its own root.
     """
+    import tkinter as tk
+
     root = tk.Tk()
     root.withdraw()
     root.attributes("-topmost", True)
+    return root
+
+
+def show_time_limit_warning():
+    """
+    Show a blocking popup with the time limit warning.
+    """
+    from tkinter import messagebox
+
+    root = _popup_root()
     messagebox.showwarning(
         "Warning",
         "The tunnel on the HPC will close in less than 1 minute! Save your work and close the IDE."
         " After accepting this warning, the tunnel will be closed locally.",
+        parent=root,
     )
     root.destroy()
 
@@ -55,17 +81,19 @@ def show_tunnel_ready_info(
     """
 
     def show_popup():
-        root = tk.Tk()
-        root.withdraw()
-        root.attributes("-topmost", True)
+        from tkinter import messagebox
+
+        root = _popup_root()
         messagebox.showinfo(
             "Info",
             f"The tunnel on the HPC is ready! You can now connect to the tunnel using "
             f"'ssh {tunnel_entry.host}' or 'ssh {local_tunnel_entry.host}'.",
+            parent=root,
         )
         root.destroy()
 
-    threading.Thread(target=show_popup).start()
+    # daemon, so an unanswered popup does not keep the process alive on exit
+    threading.Thread(target=show_popup, daemon=True).start()
 
 
 @dataclass
@@ -78,78 +106,390 @@ class JobTunnel:
     port: int | None = None
     node: str | None = None
     termination_time: datetime | None = None
-    job: SlurmJob = None
+    termination_deadline: float | None = None  # in time.monotonic() seconds
+    last_status: str | None = None
+    last_status_time: float = 0.0
+    control_path: str | None = None
+    ssh_options: List[str] = field(default_factory=list, init=False)
+    ssh_prefix: List[str] = field(default_factory=list, init=False)
+    submit_command: str = field(default="", init=False)
+    output_stream: subprocess.Popen | None = field(
+        default=None, init=False, repr=False
+    )
+    output_buffer: bytes = field(default=b"", init=False, repr=False)
+    output_lines: List[str] = field(default_factory=list, init=False, repr=False)
+
+    def __post_init__(self):
+        if self.control_path is None:
+            # %C is expanded by ssh to a hash of the connection parameters. Not
+            # in $TMPDIR: on macOS that is long enough for the socket path to
+            # exceed the 104 byte limit of unix sockets.
+            self.control_path = f"/tmp/sjt-%C-{os.getpid()}"
+        self.ssh_options = ["-o", f"ControlPath={self.control_path}"]
+        # the commands themselves never become a master, even if ControlMaster
+        # is set in ~/.ssh/config: a master holds on to its stdout, so
+        # capturing the output would hang until ControlPersist expires
+        self.ssh_prefix = [
+            "ssh",
+            *self.ssh_options,
+            "-o",
+            "ControlMaster=no",
+            self.host.host,
+        ]
+        # SBatchCommand.command is rebuilt on every access, so build it once
+        self.submit_command = self.job_command.command
+
+    def open_control_master(self) -> bool:
+        """
+        Start a background master connection to the host, which all subsequent
+        ssh calls are multiplexed over. If this fails, the calls fall back to
+        separate connections, so a failure is not fatal.
+        """
+        result = subprocess.run(
+            [
+                "ssh",
+                "-N",
+                "-f",
+                *self.ssh_options,
+                "-o",
+                "ControlMaster=auto",
+                "-o",
+                "ControlPersist=10m",
+                self.host.host,
+            ],
+        )
+        if result.returncode != 0:
+            logger.warning(
+                "Could not open a multiplexed SSH connection to %s, "
+                "falling back to separate connections",
+                self.host.host,
+            )
+            return False
+        return True
 
-    def execute_on_host(self, command: str) -> subprocess.CompletedProcess:
-        return execute_on_host(self.host.host, command)
+    def close_control_master(self) -> None:
+        subprocess.run(
+            ["ssh", "-O", "exit", *self.ssh_options, self.host.host],
+            capture_output=True,
+        )
 
-    def submit_slurm_job(self) -> int:
+    def close(self) -> None:
+        """
+        Stop the output stream and the master connection.
+        """
+        self.close_output_stream()
+        self.close_control_master()
+
+    def execute_on_host(
+        self, command: str, capture_stdout: bool = True
+    ) -> subprocess.CompletedProcess:
+        """
+        Run a command on the host. Pass `capture_stdout=False` for commands
+        whose output is not used; stderr is always captured.
+        """
+        return subprocess.run(
+            [*self.ssh_prefix, command],
+            stdin=subprocess.DEVNULL,  # don't read (or be stopped on) the tty
+            stdout=subprocess.PIPE if capture_stdout else subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            text=True,
+        )
 
-        result = self.execute_on_host(self.job_command.command)
+    def submit_slurm_job(self) -> int:
+        """
+        Submit the job and query its initial state in a single round-trip.
+        """
+        # remove the output of a previous run, so it cannot be mistaken for ours
+        script = (
+            f"rm -f {self.job_command.output}; "
+            f'out=$({self.submit_command}) || exit 1; echo "$out"; '
+            f'squeue -j "${{out##* }}" -h -o %T'
+        )
+        # run by sh explicitly, as the login shell of the user may be csh
+        result = self.execute_on_host(f"sh -c {shlex.quote(script)}")
+        # the exit code is that of the trailing squeue, so look for the job ID
+        # first: a job that was submitted must be tracked, so it is cancelled
+        match = SBATCH_JOB_ID_RE.search(result.stdout)
+        if match is None:
+            if result.returncode != 0:
+                raise RuntimeError(f"Failed to submit job: {result.stderr.strip()}")
+            raise RuntimeError(
+                f"Could not find job ID in sbatch output: {result.stdout.strip()} "
+                f"{result.stderr.strip()}"
+            )
+        self.job_id = int(match.group(1))
 
-        self.job_id = int(result.stdout.strip().split()[-1])
-        self.job = SlurmJob(job_id=self.job_id, host=self.host.host)
+        # the job state is the line following the sbatch output
+        status_lines = result.stdout[match.end() :].strip().splitlines()
+        if status_lines:
+            self.last_status = status_lines[0].strip()
+            self.last_status_time = time.monotonic()
         return self.job_id
 
     def cancel_slurm_job(self) -> None:
-        self.job.cancel()
+        if self.job_id is None:
+            return
+
+        result = self.execute_on_host(f"scancel {self.job_id}", capture_stdout=False)
+        self.last_status = None  # invalidate the cached status
+        if result.returncode != 0:
+            logger.warning(
+                "Failed to cancel job %s, cancel it manually with 'scancel %s': %s",
+                self.job_id,
+                self.job_id,
+                result.stderr.strip(),
+            )
+            return
+        logger.info("Cancelled job %s", self.job_id)
+
+    def get_job_status(
+        self, max_age: float = 2.0, refresh: bool = False
+    ) -> str | None:
+        """
+        Get the job state from squeue, reusing the last result if it is
+        younger than `max_age` seconds, unless `refresh` is set.
+
+        Returns an empty string if the job has left the queue, and None if the
+        state could not be queried (e.g. squeue or the connection failed).
+        """
+        age = time.monotonic() - self.last_status_time
+        if refresh or self.last_status is None or age >= max_age:
+            result = self.execute_on_host(f"squeue -j {self.job_id} -h -o %T")
+            if result.returncode == 0:
+                status = result.stdout.strip()
+            elif "Invalid job id" in result.stderr:
+                # squeue rejects the ID of a job that has been purged from the queue
+                status = ""
+            else:
+                logger.warning(
+                    "Could not query the state of job %s: %s",
+                    self.job_id,
+                    result.stderr.strip(),
+                )
+                return None
+            self.last_status = status
+            self.last_status_time = time.monotonic()
+        return self.last_status
+
+    def wait_until_running(
+        self, initial_interval: float = 1, max_interval: float = 30
+    ) -> None:
+        """
+        Block until the job is running. This is detected from the STARTED=
+        marker in the streamed output as soon as it is written. squeue is only
+        queried when the marker has not appeared for a while, with an
+        exponentially growing interval, to catch jobs that leave the queue
+        without running (or scripts that do not write the marker). If squeue
+        fails, the job is assumed to be still queued.
+        """
+        if self.get_job_status() == "RUNNING":
+            return
+
+        # a value from the config file is not validated by argparse; never
+        # poll faster than the initial interval
+        max_interval = max(max_interval, initial_interval)
+        interval = initial_interval
+        while True:
+            try:
+                self.watch_output_for_patterns({"started": STARTED_RE}, interval)
+                break
+            except TimeoutError:
+                status = self.get_job_status(refresh=True)
+                if status == "RUNNING":
+                    break
+                if status == "":
+                    raise RuntimeError(
+                        f"Job {self.job_id} left the queue without running"
+                    )
+                interval = min(interval * 2, max_interval)
+
+        self.last_status = "RUNNING"
+        self.last_status_time = time.monotonic()
+
+    def wait_until_finished(self, poll_interval: float = 30) -> bool:
+        """
+        Block until the job has left the queue. The queue is polled on the
+        login node, within a single ssh session.
+
+        Returns True if squeue reported the job gone, and False if polling
+        stopped because squeue or the connection failed.
+        """
+        # exit 3 if squeue fails, unless it rejects the ID of a purged job
+        script = (
+            f"while s=$(squeue -j {self.job_id} -h -o %T 2>&1) || {{ "
+            f'case "$s" in *"Invalid job id"*) exit 0;; esac; '
+            f'echo "$s" >&2; exit 3; }}; do '
+            f'[ -n "$s" ] || exit 0; sleep {poll_interval}; done'
+        )
+        # run by sh explicitly, as the login shell of the user may be csh
+        result = self.execute_on_host(
+            f"sh -c {shlex.quote(script)}", capture_stdout=False
+        )
+        if result.returncode != 0:
+            logger.warning(
+                "Stopped polling the state of job %s (exit code %s): %s",
+                self.job_id,
+                result.returncode,
+                result.stderr.strip(),
+            )
+            return False
+        return True
 
     @property
-    def status_slurm_job(self) -> str:
-        return self.job.status
+    def status_slurm_job(self) -> str | None:
+        return self.get_job_status()
 
     @property
     def is_running(self) -> bool:
-        return self.job.is_running
+        return self.get_job_status() == "RUNNING"
+
+    def follow_output(self) -> None:
+        """
+        Start streaming the job output with `tail -F`, unless already streaming.
+        The stream is kept open and the lines read are kept in `output_lines`,
+        so later watches see all output without re-reading the file.
+        """
+        if self.output_stream is None:
+            self.output_stream = subprocess.Popen(
+                [*self.ssh_prefix, f"tail -n +1 -F {self.job_command.output}"],
+                stdin=subprocess.DEVNULL,  # don't read (or be stopped on) the tty
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+            )
+
+    def close_output_stream(self) -> None:
+        if self.output_stream is not None:
+            self.output_stream.terminate()
+            self.output_stream.wait()
+            self.output_stream = None
+
+    def _read_output_line(self, deadline: float) -> str | None:
+        """
+        Read the next line from the output stream and append it to
+        `output_lines`, or return None if no full line arrived before the
+        (monotonic) deadline.
+        """
+        assert self.output_stream is not None and self.output_stream.stdout
+        stdout = self.output_stream.stdout
+
+        while b"\n" not in self.output_buffer:
+            wait = deadline - time.monotonic()
+            if wait <= 0 or not select.select([stdout], [], [], wait)[0]:
+                return None
+
+            chunk = os.read(stdout.fileno(), 4096)
+            if not chunk:
+                raise RuntimeError(
+                    f"Output stream of {self.job_command.output} closed unexpectedly"
+                )
+            self.output_buffer += chunk
+
+        line, self.output_buffer = self.output_buffer.split(b"\n", 1)
+        self.output_lines.append(line.decode(errors="replace"))
+        return self.output_lines[-1]
+
+    def watch_output_for_patterns(
+        self, patterns: Dict[str, re.Pattern], timeout: float = 60
+    ) -> Dict[str, str]:
+        """
+        Stream the job output with `tail -F` until every pattern has matched a
+        line, and return the first group of each match (or the whole match if
+        the pattern has no groups), keyed like `patterns`. Lines read by earlier
+        watches are matched as well.
+        """
+        self.follow_output()
+
+        # one alternation over all patterns, so most lines are rejected by a
+        # single search before dispatching to the individual patterns
+        any_pattern = re.compile(
+            "|".join(f"(?:{pattern.pattern})" for pattern in patterns.values())
+        )
+
+        deadline = time.monotonic() + timeout
+        remaining = dict(patterns)
+        found: Dict[str, str] = {}
+        index = 0
+        while remaining:
+            if index == len(self.output_lines) and (
+                self._read_output_line(deadline) is None
+            ):
+                raise TimeoutError(f"Timed out waiting for {list(remaining)}")
+            line = self.output_lines[index]
+            index += 1
+            if not any_pattern.search(line):
+                continue
+
+            for key, pattern in remaining.items():
+                match = pattern.search(line)
+                if match:
+                    found[key] = match.group(1 if pattern.groups else 0)
+                    del remaining[key]
+                    break
+
+        return found
 
     def watch_output_for_text(
-        self, watch_texts: List[str], wait_time: float = 0.01, timeout: float = 60
-    ) -> List[str]:
-        start_time = time.time()
-        while time.time() - start_time < timeout:
-            output = self.execute_on_host(f"cat {self.job_command.output}").stdout
-            found_texts = []
-            for line in output.splitlines():
-                for watch_text in watch_texts:
-                    if watch_text in line:
-                        found_texts.append(line)
-                if len(found_texts) == len(watch_texts):
-                    return found_texts
-            time.sleep(wait_time)
-        raise TimeoutError(f"Timed out waiting for {watch_texts}")
+        self, watch_texts: List[str], timeout: float = 60
+    ) -> Dict[str, str]:
+        """
+        Stream the job output with `tail -F` and return the first line containing
+        each watch text, keyed by watch text, as soon as all of them have been
+        written.
+        """
+        return self.watch_output_for_patterns(
+            {text: re.compile(f".*{re.escape(text)}.*") for text in watch_texts},
+            timeout=timeout,
+        )
 
     def get_tunnel_info(self) -> Tuple[int, str, datetime]:
         if not self.is_running:
             raise ValueError("Job is not running")
 
-        output_lines = self.watch_output_for_text(
-            ["PORT=", "NODE=", "This tunnel will close at: "]
+        info = self.watch_output_for_patterns(
+            {
+                "port": PORT_RE,
+                "node": NODE_RE,
+                "termination_time": TERMINATION_TIME_RE,
+            }
         )
 
-        port = next(line.split("=")[1] for line in output_lines if "PORT=" in line)
-        node = next(line.split("=")[1] for line in output_lines if "NODE=" in line)
-        termination_time = next(
-            line.split("at: ")[1]
-            for line in output_lines
-            if "This tunnel will close at: " in line
+        self.port = int(info["port"])
+        self.node = info["node"]
+        # tunnel.sbatch prints the end time as epoch seconds right before the
+        # readable one; older copies of the script only print the latter
+        end_time = next(
+            (m.group(1) for m in map(END_TIME_RE.search, self.output_lines) if m),
+            None,
         )
+        if end_time is not None:
+            end_epoch = float(end_time)
+        else:
+            end_epoch = time.mktime(
+                time.strptime(info["termination_time"], "%Y-%m-%d %H:%M:%S")
+            )
 
-        self.port = int(port)
-        self.node = node
-        self.termination_time = datetime.strptime(termination_time, "%Y-%m-%d %H:%M:%S")
+        self.termination_time = datetime.fromtimestamp(end_epoch)
+        self.termination_deadline = time.monotonic() + (end_epoch - time.time())
 
         return self.port, self.node, self.termination_time
 
 
 class LocalTunnel:
-    def __init__(self, remote_tunnel_entry: SSHConfigEntry):
+    def __init__(
+        self,
+        remote_tunnel_entry: SSHConfigEntry,
+        ssh_config: SSHConfig | None = None,
+    ):
 
         self.remote_tunnel_entry: SSHConfigEntry = remote_tunnel_entry
+        self.ssh_config: SSHConfig = (
+            ssh_config if ssh_config is not None else SSHConfig()
+        )
 
         self._port: int | None = None
-        self._thread: threading.Thread | None = None
-        self._stop_event: threading.Event = threading.Event()
-        self._created: bool = False
+        self._process: subprocess.Popen | None = None
+        self._stderr: IO[bytes] | None = None
+        self.stop_requested: bool = False
 
         self._local_tunnel_entry: SSHConfigEntry | None = None
 
@@ -161,11 +501,11 @@ class LocalTunnel:
         return self._port
 
     @property
-    def thread(self) -> threading.Thread:
-        if self._thread is None:
-            raise ValueError("Local tunnel thread is not set")
+    def process(self) -> subprocess.Popen:
+        if self._process is None:
+            raise ValueError("Local tunnel process is not set")
 
-        return self._thread
+        return self._process
 
     @property
     def local_tunnel_entry(self) -> SSHConfigEntry:
@@ -178,43 +518,36 @@ class LocalTunnel:
         self,
     ) -> int:
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.bind(("localhost", 0))
+            s.bind(("127.0.0.1", 0))
             return s.getsockname()[1]
 
-    def create(self):
+    def create(self, timeout: float = 30):
         self._port = self.find_free_port()
-        self._thread = threading.Thread(
-            target=self.thread_target,
-            daemon=False,
-        )
-        self._thread.start()
-
-        while not self._created:
-            time.sleep(0.1)
 
-    @property
-    def is_running(self) -> bool:
-        return self._thread is not None and self._thread.is_alive()
-
-    def thread_target(self):
-        ssh_command = f"ssh -N -L {self.port}:localhost:{self.remote_tunnel_entry.port} {self.remote_tunnel_entry.host}"
-        logging.info(f"Local tunnel command: {ssh_command}")
-
-        try:
-            child = pexpect.spawn(ssh_command)
-            i = child.expect(
-                [
-                    "Are you sure you want to continue connecting",
-                    pexpect.EOF,
-                    pexpect.TIMEOUT,
-                ],
-                timeout=30,
-            )
-            if i == 0:
-                child.sendline("yes")
-            child.expect(["Warning: Permanently added", pexpect.EOF], timeout=30)
-        except Exception as e:
-            logging.error(f"Error creating local tunnel: {e}")
+        ssh_command = [
+            "ssh",
+            "-N",
+            "-o",
+            "StrictHostKeyChecking=accept-new",
+            "-o",
+            "ExitOnForwardFailure=yes",
+            "-L",
+            f"{self.port}:localhost:{self.remote_tunnel_entry.port}",
+            self.remote_tunnel_entry.host,
+        ]
+        logger.info("Local tunnel command: %s", " ".join(ssh_command))
+
+        # stderr goes to a file rather than a pipe nobody drains, which could
+        # fill up and block ssh over the lifetime of the tunnel
+        self._stderr = tempfile.TemporaryFile()
+        self._process = subprocess.Popen(
+            ssh_command,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=self._stderr,
+            start_new_session=True,  # Ctrl+C is handled by our cleanup
+        )
+        self._wait_until_forwarding(timeout)
 
         self._local_tunnel_entry = SSHConfigEntry(
             host=f"{self.remote_tunnel_entry.host}-port-forward",
@@ -223,54 +556,98 @@ class LocalTunnel:
             user=self.remote_tunnel_entry.user,
         )
 
-        SSHConfig().update_config(self.local_tunnel_entry)
-        self._created = True
+        self.ssh_config.update_config(self.local_tunnel_entry)
+
+    def _wait_until_forwarding(self, timeout: float) -> None:
+        """
+        Wait until the forwarded local port accepts connections.
+        """
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                self._stderr.seek(0)
+                error = self._stderr.read().decode(errors="replace").strip()
+                raise RuntimeError(f"Local tunnel exited: {error}")
+            try:
+                with socket.create_connection(("localhost", self.port), timeout=1):
+                    return
+            except OSError:
+                time.sleep(0.1)
+
+        # ssh runs in its own session, so it would outlive us if left running
+        self.process.terminate()
+        self.process.wait()
+        raise TimeoutError("Timed out creating the local tunnel")
 
-        # listen for stop_event
-        self._stop_event.wait()
+    @property
+    def is_running(self) -> bool:
+        return self._process is not None and self._process.poll() is None
+
+    def wait(self) -> None:
+        """
+        Block until the ssh process exits.
+        """
+        self.process.wait()
 
     def _set_stop(self):
-        self._stop_event.set()
+        self.stop_requested = True
+        self.process.terminate()
 
     def cleanup(self):
 
-        SSHConfig().remove_entry(self.local_tunnel_entry.host)
+        if self._local_tunnel_entry is not None:
+            self.ssh_config.remove_entry(self._local_tunnel_entry.host)
 
-        if not self.is_running:
-            return
+        if self.is_running:
+            self._set_stop()
+            self.process.wait()
+
+        if self._stderr is not None:
+            self._stderr.close()
+            self._stderr = None
+
+
+@dataclass
+class CleanupContext:
+    """
+    Resources to clean up on exit, filled in as the tunnel is set up.
+    """
 
-        self._set_stop()
-        self.thread.join()
+    job_tunnel: JobTunnel | None = None
+    ssh_config: SSHConfig | None = None
+    tunnel_entry: SSHConfigEntry | None = None
+    local_tunnel: LocalTunnel | None = None
 
 
 def cleanup(
-    job_tunnel: JobTunnel,
+    job_tunnel: JobTunnel | None = None,
     ssh_config: SSHConfig | None = None,
     tunnel_entry: SSHConfigEntry | None = None,
     local_tunnel: LocalTunnel | None = None,
     exit: bool = True,
 ) -> None:
-    logging.info("Cleaning up the job tunnel...")
+    logger.info("Cleaning up the job tunnel...")
     if job_tunnel:
         job_tunnel.cancel_slurm_job()  # has own logging
+        job_tunnel.close()
 
     if ssh_config and tunnel_entry:
         ssh_config.remove_entry(tunnel_entry.host)
-        logging.info("Cleaned up SSH config")
+        logger.info("Cleaned up SSH config")
 
     if local_tunnel:
         local_tunnel.cleanup()
-        logging.info("Cleaned up local tunnel")
+        logger.info("Cleaned up local tunnel")
 
     if exit:
-        logging.info("Done. Goodbye!")
+        logger.info("Done. Goodbye!")
         sys.exit(0)
 
 
 def run_tunnel(config: "TunnelConfig") -> None:
 
-    script_ext = os.path.splitext(config.remote_sbatch_path)[1]
-    output = config.remote_sbatch_path.replace(f"{script_ext}", ".out")
+    # the path is on the remote, so always treat it as a POSIX path
+    output = str(PurePosixPath(config.remote_sbatch_path).with_suffix(".out"))
 
     job_command = SBatchCommand(
         script=config.remote_sbatch_path,
@@ -286,104 +663,137 @@ def run_tunnel(config: "TunnelConfig") -> None:
         ],
     )
 
-    logging.info(f"Validating SSH config")
+    logger.info("Validating SSH config")
 
-    ssh_config_path = os.path.join(os.path.expanduser("~"), ".ssh", "config")
-    ssh_config = SSHConfig(ssh_config_path)
+    ssh_config = SSHConfig(SSH_CONFIG_PATH)
     host_entry = ssh_config.get_entry(config.remote_host)
     job_tunnel = JobTunnel(
         job_command=job_command,
         host=host_entry,
     )
 
-    # if SIGINT is received, cleanup the job tunnel and exit
+    # if SIGINT is received, cleanup whatever has been set up so far and exit
+    cleanup_context = CleanupContext(job_tunnel=job_tunnel, ssh_config=ssh_config)
     signal.signal(
         signal.SIGINT,
-        lambda sig, frame: cleanup(
-            job_tunnel=job_tunnel,
-            ssh_config=ssh_config,
-            tunnel_entry=tunnel_entry,
-        ),
+        lambda sig, frame: cleanup(**vars(cleanup_context)),
     )
 
-    logging.info(
-        f"Submitting {job_command.script} to {job_tunnel.host.host} with command: {job_command.command}"
-    )
-
-    job_id = job_tunnel.submit_slurm_job()
-    logging.info(f"Submitted job. Job ID: {job_id}")
-    logging.info("Waiting for job to start")
-
-    while not job_tunnel.is_running:
-        logging.info("Job is queued, sleeping for 5 seconds")
-        time.sleep(5)
+    try:
+        logger.info("Opening multiplexed SSH connection to %s", job_tunnel.host.host)
+        job_tunnel.open_control_master()
 
-    logging.info("Job is running")
-    port, node, termination_time = job_tunnel.get_tunnel_info()
-
-    logging.info(f"Tunnel established (node={node}, port={port})")
-    logging.info(
-        f"This tunnel will terminate at {termination_time.strftime('%Y-%m-%d %H:%M:%S')}"
-    )
-
-    tunnel_entry = SSHConfigEntry(
-        host=f"{host_entry.host}-job",
-        hostname=node,
-        port=port,
-        user=host_entry.user,
-        proxy=host_entry.host,
-    )
-    logging.info(f"Updating SSH config: adding tunnel host '{tunnel_entry.host}'")
+        logger.info(
+            "Submitting %s to %s with command: %s",
+            job_command.script,
+            job_tunnel.host.host,
+            job_tunnel.submit_command,
+        )
 
-    ssh_config.update_config(tunnel_entry)
+        job_id = job_tunnel.submit_slurm_job()
+        logger.info("Submitted job. Job ID: %s. Waiting for job to start", job_id)
 
-    logging.info(f"Added tunnel host '{tunnel_entry.host}' to {ssh_config_path}")
+        # start streaming the output while queued, so it is ready once the job runs
+        job_tunnel.follow_output()
 
-    logging.info(
-        f"SSH config tunnel entry: \n\n{ssh_config.get_entry(tunnel_entry.host)}"
-    )
-    # find random free port on localhost
+        job_tunnel.wait_until_running(max_interval=config.max_poll_interval)
 
-    logging.info(f"Creating local tunnel to {tunnel_entry.host}:{tunnel_entry.port}")
+        logger.info("Job is running")
+        port, node, termination_time = job_tunnel.get_tunnel_info()
 
-    local_tunnel = LocalTunnel(tunnel_entry)
-    local_tunnel.create()
+        logger.info(
+            "Tunnel established (node=%s, port=%s)\nThis tunnel will terminate at %s",
+            node,
+            port,
+            termination_time.strftime("%Y-%m-%d %H:%M:%S"),
+        )
 
-    logging.info(
-        f"Added local port forwarding host '{local_tunnel.local_tunnel_entry.host}' to {ssh_config_path}"
-    )
+        tunnel_entry = SSHConfigEntry(
+            host=f"{host_entry.host}-job",
+            hostname=node,
+            port=port,
+            user=host_entry.user,
+            proxy=host_entry.host,
+        )
+        logger.info("Updating SSH config: adding tunnel host '%s'", tunnel_entry.host)
 
-    logging.info(
-        f"SSH config local tunnel entry: \n\n{ssh_config.get_entry(local_tunnel.local_tunnel_entry.host)}"
-    )
+        cleanup_context.tunnel_entry = tunnel_entry
+        ssh_config.update_config(tunnel_entry)
 
-    # if SIGINT is received, cleanup the job tunnel and local tunnel and exit
-    signal.signal(
-        signal.SIGINT,
-        lambda sig, frame: cleanup(
-            job_tunnel=job_tunnel,
-            ssh_config=ssh_config,
-            tunnel_entry=tunnel_entry,
-            local_tunnel=local_tunnel,
-        ),
-    )
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(
+                "Added tunnel host '%s' to %s. SSH config tunnel entry: \n\n%s",
+                tunnel_entry.host,
+                SSH_CONFIG_PATH,
+                ssh_config.get_entry(tunnel_entry.host),
+            )
 
-    show_tunnel_ready_info(tunnel_entry, local_tunnel.local_tunnel_entry)
+        logger.info(
+            "Creating local tunnel to %s:%s", tunnel_entry.host, tunnel_entry.port
+        )
 
-    logging.info(
-        "To cancel the slurm job and close this job tunnel, stop this script by pressing Ctrl+C. "
-    )
+        local_tunnel = LocalTunnel(tunnel_entry, ssh_config=ssh_config)
+        cleanup_context.local_tunnel = local_tunnel
+        local_tunnel.create()
+
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(
+                "Added local port forwarding host '%s' to %s. "
+                "SSH config local tunnel entry: \n\n%s",
+                local_tunnel.local_tunnel_entry.host,
+                SSH_CONFIG_PATH,
+                ssh_config.get_entry(local_tunnel.local_tunnel_entry.host),
+            )
 
-    assert job_tunnel.termination_time is not None, "Termination time is not set"
+        show_tunnel_ready_info(tunnel_entry, local_tunnel.local_tunnel_entry)
 
-    time.sleep((job_tunnel.termination_time - datetime.now()).total_seconds() - 60)
-    logging.info("Tunnel will close in 1 minute!")
-    show_time_limit_warning()
-    logging.info("Tunnel closed")
+        logger.info(
+            "To cancel the slurm job and close this job tunnel, stop this script by pressing Ctrl+C. "
+        )
 
-    cleanup(
-        job_tunnel=job_tunnel,
-        ssh_config=ssh_config,
-        tunnel_entry=tunnel_entry,
-        local_tunnel=local_tunnel,
-    )
+        assert (
+            job_tunnel.termination_deadline is not None
+        ), "Termination time is not set"
+
+        # wake up early if the job ends before its time limit (e.g. preemption),
+        # or if the local port forwarding dies
+        tunnel_closed = threading.Event()
+
+        def watch_job_end():
+            # a failed squeue or dropped connection does not mean the job ended,
+            # so confirm before closing the tunnel (and cancelling the job)
+            while True:
+                if job_tunnel.wait_until_finished():
+                    status = job_tunnel.get_job_status(refresh=True)
+                    if status == "":
+                        break
+                    if status is not None:
+                        continue
+                time.sleep(30)
+
+            logger.warning("Job ended before its time limit")
+            tunnel_closed.set()
+
+        def watch_local_tunnel():
+            local_tunnel.wait()
+            if not local_tunnel.stop_requested:
+                logger.warning("Local tunnel closed unexpectedly")
+                tunnel_closed.set()
+
+        threading.Thread(target=watch_job_end, daemon=True).start()
+        threading.Thread(target=watch_local_tunnel, daemon=True).start()
+
+        seconds_until_warning = job_tunnel.termination_deadline - time.monotonic() - 60
+        if not tunnel_closed.wait(timeout=max(0, seconds_until_warning)):
+            logger.info("Tunnel will close in 1 minute!")
+            show_time_limit_warning()
+        logger.info("Tunnel closed")
+    except SystemExit:
+        raise  # raised by cleanup() on Ctrl+C, after it has cleaned up
+    except BaseException:
+        # release the job and local resources on any error while setting up or
+        # running the tunnel, then let the error propagate
+        cleanup(**vars(cleanup_context), exit=False)
+        raise
+
+    cleanup(**vars(cleanup_context))
@@ -5,12 +5,10 @@ Copyright (c) 2024 by Wiep K. van der Toorn
 
 """
 
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass, asdict, fields
 
-from slurm_job_util.slurm_job import SBatchCommand
 
-
-@dataclass
+@dataclass(slots=True, frozen=True)
 class TunnelConfig:
     remote_host: str = "hpc-login"
     time: str = "1:00:00"
@@ -27,6 +25,7 @@ class TunnelConfig:
     remote_sbatch_path: str = "tunnel.sbatch"
     remote_sif_path: str = "singularity/openssh.sif"
     sif_bind_path: str = "/scratch/$USER"
+    max_poll_interval: int = 30
 
     def to_dict(self):
         return asdict(self)
@@ -35,9 +34,11 @@ class TunnelConfig:
         return getattr(self, key, None)
 
     def sbatch_kwargs(self) -> dict:
+        from slurm_job_util.slurm_job import SBatchCommand
+
         return {
             k: self.get(k)
-            for k in SBatchCommand.__dict__["__dataclass_fields__"].keys()
+            for k in (field.name for field in fields(SBatchCommand))
             if self.get(k) is not None
         }
 
@@ -60,6 +61,7 @@ class TunnelConfig:
             "remote_sbatch_path": "The path to the tunnel.sbatch script on the remote, from the home directory of the remote user.",
             "remote_sif_path": "The path to the singularity image on the remote, from the home directory of the remote user.",
             "sif_bind_path": "The path to bind the singularity image to on the remote.",
+            "max_poll_interval": "The maximum number of seconds between checks whether the queued SLURM job has started.",
         }
 
     @staticmethod